@@ -525,6 +525,33 @@ function speak(text) {
     });
 }
 
+// Queue text after whatever is already being spoken (no cancel), used for streamed answers
+function speakQueued(text) {
+    return new Promise((resolve) => {
+        if (!window.speechSynthesis) {
+            resolve();
+            return;
+        }
+
+        isSpeaking = true;
+        const utterance = new SpeechSynthesisUtterance(text);
+        utterance.lang = 'sl-SI';
+        utterance.rate = 0.9;
+
+        utterance.onend = () => {
+            isSpeaking = window.speechSynthesis.speaking;
+            resolve();
+        };
+
+        utterance.onerror = () => {
+            isSpeaking = window.speechSynthesis.speaking;
+            resolve();
+        };
+
+        window.speechSynthesis.speak(utterance);
+    });
+}
+
 // --- MICROPHONE PERMISSION MANAGEMENT ---
 let microphonePermissionGranted = false;
 let microphonePermissionRequested = false;
@@ -773,10 +800,11 @@ async function submitQuestion() {
     vprasajResponse.hidden = false;
     vprasajResponse.textContent = "Razmišljam...";
     vprasajSubmitBtn.disabled = true;
+    let answer = "";
 
     try {
-        // Use the actual API call from your original script
-        const res = await fetch('/ask', {
+        // Stream the answer so reading aloud starts with the first finished sentence
+        const res = await fetch('/ask/stream', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ question, subject })
@@ -786,15 +814,63 @@ async function submitQuestion() {
             throw new Error(`HTTP error! status: ${res.status}`);
         }
 
-        const data = await res.json();
+        if (window.speechSynthesis) {
+            window.speechSynthesis.cancel();
+        }
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let spokenUpTo = 0;
+        let lastUtterance = Promise.resolve();
+        let interrupted = false;
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            answer += decoder.decode(value, { stream: true });
+            // The server appends STREAM_ERROR_MARKER (NUL) when generation fails midway
+            const markerAt = answer.indexOf('\u0000');
+            if (markerAt !== -1) {
+                answer = answer.slice(0, markerAt);
+                interrupted = true;
+            }
+            vprasajResponse.textContent = answer;
+
+            // Speak every sentence that is complete so far
+            const sentenceEnd = Math.max(
+                answer.lastIndexOf('. '), answer.lastIndexOf('! '),
+                answer.lastIndexOf('? '), answer.lastIndexOf('\n')
+            ) + 1;
+            if (sentenceEnd > spokenUpTo) {
+                const sentences = answer.slice(spokenUpTo, sentenceEnd);
+                spokenUpTo = sentenceEnd;
+                if (sentences.trim()) {
+                    lastUtterance = speakQueued(sentences);
+                }
+            }
+            if (interrupted) break;
+        }
+        if (interrupted) {
+            // let the sentences already queued finish, then report the cut-off answer as an error
+            await lastUtterance;
+            throw new Error('Odgovor je bil prekinjen');
+        }
+        answer += decoder.decode();
+        if (!answer.trim()) {
+            throw new Error('Prazen odgovor');
+        }
+        vprasajResponse.textContent = answer;
 
-        vprasajResponse.textContent = data.answer;
-        await speak(data.answer);
+        const rest = answer.slice(spokenUpTo);
+        if (rest.trim()) {
+            lastUtterance = speakQueued(rest);
+        }
+        await lastUtterance;
         vprasajStatus.textContent = "Odgovorjeno.";
         vprasajSubmitBtn.disabled = false;
         showToast('Vprašanje odgovorjeno', 'Odgovor je bil prebran na glas.', 'success');
     } catch (err) {
-        vprasajResponse.textContent = "Napaka: " + err.message;
+        // keep any partial answer on screen, followed by the error
+        vprasajResponse.textContent = (answer.trim() ? answer + "\n\n" : "") + "Napaka: " + err.message;
         await speak("Oprostite, prišlo je do napake.");
         vprasajStatus.textContent = "Prišlo je do napake.";
         vprasajSubmitBtn.disabled = false;
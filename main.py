@@ -1,8 +1,12 @@
 import os
-import shutil
-from typing import List, Optional
+import string
+import asyncio
+import hashlib
+import itertools
+from collections import OrderedDict
+from typing import List, Optional, Tuple
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
@@ -26,7 +30,28 @@ app.add_middleware(
 
 # Initialize RAG
 # Ensure DB and Index exist or will be created
-rag = FaissRAG(db_path="faiss_rag.db", index_path="faiss.index")
+# Use the int8 ONNX export of the embedder when it has been generated (see README), else PyTorch
+ONNX_MODEL_DIR = "onnx-int8"
+rag = FaissRAG(db_path="faiss_rag.db", index_path="faiss.index",
+               onnx_model_dir=ONNX_MODEL_DIR if os.path.isdir(ONNX_MODEL_DIR) else None)
+
+# Max concurrent Gemini metadata calls across all uploads
+GEMINI_CONCURRENCY = 3
+gemini_semaphore: Optional[asyncio.Semaphore] = None
+
+@app.on_event("startup")
+async def start_ingest_worker():
+    global gemini_semaphore
+    # created here so it is bound to the server's event loop
+    gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    # background embedder that batches chunks queued by /upload
+    rag.start_ingest_worker()
+
+@app.on_event("shutdown")
+async def stop_ingest_worker():
+    await rag.stop_ingest_worker()
+    # write any index changes still waiting for the debounced save
+    rag.flush()
 
 # Initialize Gemini Client
 # HARDCODED API KEY AS PER USER'S EXISTING model.py - IN PRODUCTION USE ENV VARS
@@ -46,7 +71,8 @@ class LectureRequest(BaseModel):
 # Routes
 
 # Helper function for Gemini metadata generation
-def generate_metadata_with_gemini(text: str, existing_subjects: List[str]) -> dict:
+async def generate_metadata_with_gemini(text: str, existing_subjects: List[str]) -> dict:
+    # only the first 2000 chars are sent, so callers can pass just the document head
     prompt = f"""
     You are a helpful assistant. Analyze the following document text and generate a title and a subject for it.
     Extend your answer to further help student with learning and understanding. No more than 200 chars.
@@ -67,64 +93,84 @@ def generate_metadata_with_gemini(text: str, existing_subjects: List[str]) -> di
     """
     
     try:
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt,
-            config={'response_mime_type': 'application/json'}
-        )
+        async with gemini_semaphore:
+            response = await client.aio.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=prompt,
+                config={'response_mime_type': 'application/json'}
+            )
         return json.loads(response.text)
     except Exception as e:
         print(f"Error generating metadata with Gemini: {e}")
         # Fallback
         return {"title": "Untitled Document", "subject": "Uncategorized"}
 
+async def process_upload(file: UploadFile, job_id: str, existing_subjects: List[str]) -> dict:
+    # Extract straight from the upload stream (already spooled by Starlette), no temp copy.
+    # Only the pages needed for the Gemini prompt are parsed up front; the rest is streamed
+    # into the ingest queue, so each file is parsed exactly once.
+    try:
+        head, rest = await asyncio.to_thread(
+            Extractor.extract_with_head, file.file, 2000, os.path.splitext(file.filename)[1]
+        )
+    except Exception as e:
+        print(f"Extraction failed for {file.filename}: {e}")
+        head, rest = "", iter([])
+    
+    # Generate metadata
+    metadata = await generate_metadata_with_gemini(head, existing_subjects)
+    metadata['filename'] = file.filename
+    print(f"Generated metadata for {file.filename}: {metadata}")
+    
+    # Queue chunks for the shared background embedder, which batches them across files
+    try:
+        await rag.enqueue_text(job_id, itertools.chain([head], rest), metadata=metadata)
+    except Exception as e:
+        # a page past the head failed to parse; chunks queued before it are still indexed
+        print(f"Extraction failed for {file.filename}: {e}")
+        rag.fail_job(job_id, f"{file.filename}: {e}")
+        return {"filename": file.filename, "metadata": metadata, "error": str(e)}
+    return {"filename": file.filename, "metadata": metadata}
+
 @app.post("/upload")
 async def upload_files(files: List[UploadFile] = File(...)):
-    temp_paths = []
-    processed_files = []
     print(files)
     try:
         existing_subjects = rag.get_subjects()
         
-        for file in files:
-            temp_path = f"temp_{file.filename}"
-            with open(temp_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            temp_paths.append(temp_path)
-            
-            # Extract text for Gemini
-            try:
-                text = Extractor.from_file(temp_path)
-            except Exception as e:
-                print(f"Extraction failed for {file.filename}: {e}")
-                text = ""
-            
-            # Generate metadata
-            metadata = generate_metadata_with_gemini(text, existing_subjects)
-            metadata['filename'] = file.filename
-            print(f"Generated metadata for {file.filename}: {metadata}")
-            
-            # Add to RAG with generated metadata
-            rag.add_files([temp_path], metadata=metadata)
-            processed_files.append({"filename": file.filename, "metadata": metadata})
-            
-            # Update existing subjects if a new one was created (optimization)
-            if metadata['subject'] not in existing_subjects:
-                existing_subjects.append(metadata['subject'])
+        # Files are processed concurrently; the request does not wait for embedding
+        job_id = rag.open_job()
+        try:
+            # one failing file must not abort the others (or leave them reading closed uploads)
+            results = await asyncio.gather(*[process_upload(file, job_id, existing_subjects) for file in files],
+                                           return_exceptions=True)
+        finally:
+            rag.close_job(job_id)
+        processed_files = []
+        for file, result in zip(files, results):
+            if isinstance(result, BaseException):
+                print(f"Processing failed for {file.filename}: {result}")
+                rag.fail_job(job_id, f"{file.filename}: {result}")
+                result = {"filename": file.filename, "error": str(result)}
+            processed_files.append(result)
         
-        return {"message": f"Successfully processed {len(files)} files.", "details": processed_files}
+        return {"message": f"Successfully processed {len(files)} files.", "job_id": job_id, "details": processed_files}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # Cleanup temp files
-        for p in temp_paths:
-            if os.path.exists(p):
-                os.remove(p)
+
+@app.get("/upload/{job_id}")
+async def upload_status(job_id: str):
+    status = rag.job_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return status
 
 @app.post("/add_lecture")
 async def add_lecture(lecture: LectureRequest):
     try:
-        rag.add_text(lecture.text, metadata={"title": lecture.title, "type": "lecture", "subject": lecture.subject})
+        # chunking + embedding are CPU-bound (and may wait on the ingest worker), keep them off the event loop
+        await asyncio.to_thread(rag.add_text, lecture.text,
+                                metadata={"title": lecture.title, "type": "lecture", "subject": lecture.subject})
         return {"message": "Lecture saved successfully."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -137,20 +183,38 @@ async def list_documents(subject: Optional[str] = None):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/ask")
-async def ask_question(req: QuestionRequest):
-    try:
-        # 1. Retrieve context from RAG
-        import string; cleaned = req.question.translate(str.maketrans('', '', string.punctuation))
-        results = rag.hybrid_search(cleaned, k=5, subject=req.subject)
-        print(results)
-        context_text = "\n\n".join([f"Source ({r['metadata'].get('title', 'doc')}): {r['content']}" for r in results])
-        
-        if not context_text:
-            context_text = "No relevant documents found."
+# Recent answers keyed by (normalized question, retrieved chunk ids); repeated questions skip Gemini
+ANSWER_CACHE_SIZE = 512
+answer_cache: "OrderedDict[bytes, str]" = OrderedDict()
+
+def answer_cache_key(question: str, results: List[dict]) -> bytes:
+    raw = question.lower().strip() + "|" + str(sorted(r['id'] for r in results))
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).digest()
+
+def get_cached_answer(key: bytes) -> Optional[str]:
+    answer = answer_cache.get(key)
+    if answer is not None:
+        answer_cache.move_to_end(key)
+    return answer
+
+def cache_answer(key: bytes, answer: str):
+    answer_cache[key] = answer
+    while len(answer_cache) > ANSWER_CACHE_SIZE:
+        answer_cache.popitem(last=False)
 
-        # 2. Generate answer with Gemini
-        prompt = f"""
+async def retrieve_context(req: QuestionRequest) -> Tuple[List[dict], str]:
+    cleaned = req.question.translate(str.maketrans('', '', string.punctuation))
+    # embedding + FAISS search are CPU-bound, keep them off the event loop
+    results = await asyncio.to_thread(rag.hybrid_search, cleaned, 5, 0.5, req.subject)
+    print(results)
+    context_text = "\n\n".join([f"Source ({r['metadata'].get('title', 'doc')}): {r['content']}" for r in results])
+    
+    if not context_text:
+        context_text = "No relevant documents found."
+    return results, context_text
+
+def build_answer_prompt(context_text: str, question: str) -> str:
+    return f"""
         You are a helpful assistant for a blind or visually impaired user. You always answer in slovene
         Answer the user's question based ONLY on the provided context.
         Keep the answer concise, clear, and easy to understand when read aloud (TTS).
@@ -160,15 +224,27 @@ async def ask_question(req: QuestionRequest):
         {context_text}
         
         User Question:
-        {req.question}
+        {question}
         """
-        
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt,
-        )
-        
-        answer = response.text
+
+@app.post("/ask")
+async def ask_question(req: QuestionRequest):
+    try:
+        # 1. Retrieve context from RAG
+        results, context_text = await retrieve_context(req)
+
+        # 2. Generate answer with Gemini (unless this question was just answered from the same context)
+        key = answer_cache_key(req.question, results)
+        answer = get_cached_answer(key)
+        if answer is None:
+            response = await client.aio.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=build_answer_prompt(context_text, req.question),
+            )
+            answer = response.text or ""
+            if answer:
+                # blocked/empty responses are not cached, so the next ask retries Gemini
+                cache_answer(key, answer)
         
         return {
             "answer": answer,
@@ -178,6 +254,48 @@ async def ask_question(req: QuestionRequest):
         print(f"Error in /ask: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Sent instead of the rest of the answer when Gemini fails mid-stream (headers are already sent,
+# so the status code cannot change); the client treats the answer as cut off
+STREAM_ERROR_MARKER = "\u0000"
+
+@app.post("/ask/stream")
+async def ask_question_stream(req: QuestionRequest):
+    """
+    Same as /ask, but streams the answer as plain text so TTS can start on the first sentence.
+    If generation fails midway the stream ends with STREAM_ERROR_MARKER.
+    """
+    try:
+        results, context_text = await retrieve_context(req)
+    except Exception as e:
+        print(f"Error in /ask/stream: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    key = answer_cache_key(req.question, results)
+    cached = get_cached_answer(key)
+    
+    async def stream_answer():
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        try:
+            async for chunk in await client.aio.models.generate_content_stream(
+                model="gemini-2.5-flash",
+                contents=build_answer_prompt(context_text, req.question),
+            ):
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+        except Exception as e:
+            print(f"Error in /ask/stream: {e}")
+            yield STREAM_ERROR_MARKER
+            return
+        answer = "".join(parts)
+        if answer:
+            cache_answer(key, answer)
+    
+    return StreamingResponse(stream_answer(), media_type="text/plain; charset=utf-8")
+
 # Serve static files (Frontend)
 app.mount("/", StaticFiles(directory=".", html=True), name="static")
 
@@ -5,10 +5,13 @@ Production-ready skeleton for a FAISS-backed RAG document store.
 Features:
  - extract text from PDF, PPTX, DOCX, TXT, MD
  - store documents in SQLite (with FTS5 for keyword search)
- - store vectors in FAISS (IndexFlatIP wrapped with IndexIDMap for persistent IDs)
- - pluggable embedding model (default: sentence-transformers)
+ - store vectors in FAISS (HNSW over 8-bit scalar-quantized inner product, wrapped with IndexIDMap2
+   for persistent IDs, upgraded to IVF-PQ for very large corpora)
+ - pluggable embedding model (default: sentence-transformers; optional int8 ONNX Runtime export)
  - functions: add_files, add_text, search_similarity, search_keyword, hybrid_search, save, load
- - chunking support for long documents
+ - background ingestion: enqueue_text feeds a bounded queue drained by one embedder task in micro-batches
+ - persistent content-hash embedding cache, so re-ingested or duplicated chunks are not re-embedded
+ - chunking support for long documents (token-aware when the embedder exposes a fast tokenizer)
  - subject-based filtering
 
 Dependencies (pip):
@@ -16,15 +19,26 @@ faiss-cpu, sentence-transformers, pdfplumber, python-docx, python-pptx, tqdm
 
 Notes:
  - This is a single-file module intended as a starting point for production usage.
- - For heavy production workloads consider async ingestion, batching, multiprocessing, secure storage, encryption, monitoring.
+ - For heavy production workloads consider multiprocessing, secure storage, encryption, monitoring.
 """
 
 import os
 import io
+import copy
 import json
 import sqlite3
 import math
-from typing import List, Optional, Dict, Tuple, Iterable
+import time
+import uuid
+import atexit
+import hashlib
+import asyncio
+import threading
+import itertools
+import contextlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Tuple, Iterable, Iterator, Union
 
 import numpy as np
 from tqdm import tqdm
@@ -40,6 +54,26 @@ try:
 except Exception as e:
     SentenceTransformer = None
 
+try:
+    import torch
+except Exception:
+    torch = None
+
+try:
+    import onnxruntime as ort
+except Exception:
+    ort = None
+
+try:
+    from transformers import AutoTokenizer
+except Exception:
+    AutoTokenizer = None
+
+try:
+    import numba
+except Exception:
+    numba = None
+
 try:
     import pdfplumber
 except Exception:
@@ -62,126 +96,336 @@ def ensure_dir(path: str):
     os.makedirs(os.path.dirname(path), exist_ok=True) if os.path.dirname(path) else None
 
 
-def normalize_embeddings(embs: np.ndarray) -> np.ndarray:
-    # normalize rows to unit length for cosine similarity (dot product)
-    norms = np.linalg.norm(embs, axis=1, keepdims=True)
-    norms[norms == 0] = 1.0
-    return embs / norms
+class RWLock:
+    """
+    Readers-writer lock: any number of readers at once, or a single writer. Waiting writers
+    block new readers, so a steady stream of searches cannot starve ingestion. Not reentrant.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
 
-def chunk_text(text: str, size: int = 500, overlap: int = 50) -> List[str]:
+def _rrf_fuse(sem_ids: np.ndarray, kw_ids: np.ndarray, alpha: float, rrf_k: int):
     """
-    Simple character-based chunking.
+    Weighted Reciprocal Rank Fusion of two ranked id lists (best first, no repeats within a list).
+    Returns (ids, scores, sem_pos, kw_pos) sorted by fused score, best first; sem_pos/kw_pos give
+    each id's position in the input lists, -1 where absent. Pure array code, so it is compiled
+    with Numba when available.
     """
-    if not text:
-        return []
+    all_ids = np.unique(np.concatenate((sem_ids, kw_ids)))
+    n = all_ids.shape[0]
+    scores = np.zeros(n, dtype=np.float64)
+    sem_pos = np.full(n, -1, dtype=np.int64)
+    kw_pos = np.full(n, -1, dtype=np.int64)
+
+    slots = np.searchsorted(all_ids, sem_ids)
+    ranks = np.arange(sem_ids.shape[0])
+    scores[slots] += alpha / (rrf_k + ranks + 1.0)
+    sem_pos[slots] = ranks
+
+    slots = np.searchsorted(all_ids, kw_ids)
+    ranks = np.arange(kw_ids.shape[0])
+    scores[slots] += (1.0 - alpha) / (rrf_k + ranks + 1.0)
+    kw_pos[slots] = ranks
+
+    order = np.argsort(-scores, kind='mergesort')
+    return all_ids[order], scores[order], sem_pos[order], kw_pos[order]
+
+
+if numba is not None:
+    _rrf_fuse = numba.njit(cache=True)(_rrf_fuse)
+
+
+def iter_chunks(text: Union[str, Iterable[str]], size: int = 500, overlap: int = 50,
+                tokenizer=None, chunk_tokens: int = 200, overlap_tokens: int = 20) -> Iterator[str]:
+    """
+    Split text into overlapping chunks. text may be a string or an iterable of text pieces
+    (e.g. Extractor.iter_pages); pieces are consumed one at a time and each chunk is yielded as
+    soon as it is complete, holding at most one window plus the current piece in memory.
+    With a fast HuggingFace tokenizer (e.g. the embedder's), windows are chunk_tokens tokens wide
+    with overlap_tokens overlap and are cut at token offsets, so no chunk is truncated by the
+    embedding model. Without one, falls back to simple character-based chunking.
+    """
+    parts = [text] if isinstance(text, str) else text
+    if tokenizer is not None:
+        yield from _iter_token_chunks(parts, tokenizer, chunk_tokens, overlap_tokens)
+        return
+    step = size - overlap
+    buf = ""
+    for part in parts:
+        buf += part
+        while len(buf) >= size:
+            yield buf[:size]
+            buf = buf[step:]
+    while buf:
+        yield buf[:size]
+        buf = buf[step:]
+
+
+def _iter_token_chunks(parts: Iterable[str], tokenizer, chunk_tokens: int, overlap_tokens: int) -> Iterator[str]:
+    step = chunk_tokens - overlap_tokens
+    buf = ""
+    for part in parts:
+        buf += part
+        offsets = tokenizer(buf, return_offsets_mapping=True, add_special_tokens=False, verbose=False)['offset_mapping']
+        start = 0
+        # emit only windows followed by more tokens: the last token may continue in the next piece
+        while start + chunk_tokens < len(offsets):
+            yield buf[offsets[start][0]:offsets[start + chunk_tokens - 1][1]]
+            start += step
+        if start:
+            buf = buf[offsets[start][0]:]
+    if buf:
+        yield from _chunk_by_tokens(buf, tokenizer, chunk_tokens, overlap_tokens)
+
+
+def _chunk_by_tokens(text: str, tokenizer, chunk_tokens: int, overlap_tokens: int) -> List[str]:
+    enc = tokenizer(text, return_offsets_mapping=True, add_special_tokens=False, verbose=False)
+    offsets = enc['offset_mapping']
     chunks = []
-    start = 0
-    text_len = len(text)
-    while start < text_len:
-        end = start + size
-        chunk = text[start:end]
-        chunks.append(chunk)
-        start += size - overlap
+    step = chunk_tokens - overlap_tokens
+    for start in range(0, len(offsets), step):
+        end = min(start + chunk_tokens, len(offsets))
+        chunks.append(text[offsets[start][0]:offsets[end - 1][1]])
+        if end == len(offsets):
+            break
     return chunks
 
 # --------------------------- Storage: SQLite with FTS5 ---------------------------
 
+def subject_key(subject) -> Optional[str]:
+    """
+    Case-insensitive key for subject filters. Computed in Python and stored with each chunk
+    (documents.subject_key), so every search leg agrees (SQLite's own lower() only folds ASCII).
+    """
+    return None if subject is None else str(subject).casefold()
+
+# SQL expression identifying the file a chunk came from (JSON1 functions, built into stock SQLite)
+FILE_KEY_SQL = "COALESCE(json_extract(metadata, '$.source_path'), json_extract(metadata, '$.filename'), 'unknown')"
+
 class DocumentStore:
     """
     SQLite-backed document store with FTS5 for keyword search.
-    Stores: documents(id INTEGER PRIMARY KEY, content TEXT, metadata JSON string)
+    Stores: documents(id INTEGER PRIMARY KEY, content TEXT, metadata JSON string, subject_key TEXT)
     Also stores an FTS virtual table 'docs_fts(content, metadata, id UNINDEXED)'
     """
 
-    def __init__(self, db_path: str = "faiss_rag.db"):
+    def __init__(self, db_path: str = "faiss_rag.db", cache_size: int = 4096):
         self.db_path = db_path
         self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # LRU of hydrated rows (id -> doc dict) for search result assembly
+        self._cache: "OrderedDict[int, Dict]" = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
         self._init_db()
 
     def _init_db(self):
         cur = self.conn.cursor()
+        # WAL lets searches read while ingestion writes; NORMAL sync only fsyncs at checkpoints
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA cache_size=-65536")
         cur.execute("""
             CREATE TABLE IF NOT EXISTS documents (
                 id INTEGER PRIMARY KEY,
                 content TEXT NOT NULL,
-                metadata TEXT
+                metadata TEXT,
+                subject_key TEXT
             );
         """)
+        # databases created before subject_key existed: add the column (filled in below)
+        columns = [row[1] for row in cur.execute("PRAGMA table_info(documents)")]
+        if 'subject_key' not in columns:
+            cur.execute("ALTER TABLE documents ADD COLUMN subject_key TEXT")
         # FTS5 table for content + metadata search. Use direct insert into FTS for simplicity.
         cur.execute("""
             CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(content, metadata, tokenize = 'porter');
         """)
+        # fill subject_key for rows written without it (older versions, external scripts)
+        cur.execute("""
+            SELECT id, json_extract(metadata, '$.subject') FROM documents
+            WHERE subject_key IS NULL AND json_extract(metadata, '$.subject') IS NOT NULL
+        """)
+        cur.executemany("UPDATE documents SET subject_key = ? WHERE id = ?",
+                        [(subject_key(subject), doc_id) for doc_id, subject in cur.fetchall()])
+        # older subject indexes: ASCII-only lower(), then an expression over a Python function
+        cur.execute("DROP INDEX IF EXISTS idx_meta_subject")
+        cur.execute("DROP INDEX IF EXISTS idx_meta_subject_key")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_subject_key ON documents(subject_key)")
+        # expression index over the JSON metadata for per-file grouping
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_meta_file ON documents({FILE_KEY_SQL})")
         self.conn.commit()
 
     def add(self, content: str, metadata: Optional[Dict] = None) -> int:
-        cur = self.conn.cursor()
-        metadata_json = json.dumps(metadata or {})
-        cur.execute("INSERT INTO documents (content, metadata) VALUES (?, ?)", (content, metadata_json))
-        doc_id = cur.lastrowid
-        cur.execute("INSERT INTO docs_fts(rowid, content, metadata) VALUES (?, ?, ?)", (doc_id, content, metadata_json))
-        self.conn.commit()
-        return doc_id
+        return self.add_many([(content, json.dumps(metadata or {}))])[0]
+
+    def add_many(self, rows: List[Tuple[str, str]]) -> List[int]:
+        """
+        Insert (content, metadata_json) rows into documents and docs_fts in a single transaction,
+        so a whole batch costs one commit. Returns the new ids in input order.
+        """
+        if not rows:
+            return []
+        with self._lock, self.conn:
+            cur = self.conn.cursor()
+            # executemany() does not report lastrowid, so ids are assigned explicitly from the
+            # current max (documents is append-only)
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM documents")
+            start = cur.fetchone()[0] + 1
+            ids = list(range(start, start + len(rows)))
+            id_rows = [(doc_id, content, metadata_json) for doc_id, (content, metadata_json) in zip(ids, rows)]
+            cur.executemany("INSERT INTO documents (id, content, metadata, subject_key) VALUES (?, ?, ?, ?)",
+                            [row + (subject_key(json.loads(row[2] or "{}").get('subject')),) for row in id_rows])
+            cur.executemany("INSERT INTO docs_fts(rowid, content, metadata) VALUES (?, ?, ?)", id_rows)
+        # rows are never rewritten today, but drop cached rows on every write so the cache
+        # cannot serve stale data if that ever changes
+        with self._cache_lock:
+            self._cache.clear()
+        return ids
 
     def get(self, doc_id: int) -> Optional[Dict]:
+        return self.get_many([doc_id]).get(doc_id)
+
+    def get_many(self, doc_ids: Iterable[int]) -> Dict[int, Dict]:
+        """
+        Fetch several documents at once: cached rows are served from the LRU, the rest with
+        one SELECT ... WHERE id IN (...). Missing ids are absent from the returned dict.
+        """
+        found = {}
+        missing = []
+        with self._cache_lock:
+            for doc_id in doc_ids:
+                doc = self._cache.get(doc_id)
+                if doc is not None:
+                    self._cache.move_to_end(doc_id)
+                    found[doc_id] = doc
+                else:
+                    missing.append(doc_id)
+        if not missing:
+            return found
+
         cur = self.conn.cursor()
-        cur.execute("SELECT id, content, metadata FROM documents WHERE id = ?", (doc_id,))
-        row = cur.fetchone()
-        if not row:
-            return None
-        return {"id": row[0], "content": row[1], "metadata": json.loads(row[2] or "{}")}
+        fetched = []
+        # stay below SQLITE_MAX_VARIABLE_NUMBER on older SQLite builds
+        for i in range(0, len(missing), 900):
+            batch = missing[i:i + 900]
+            placeholders = ",".join("?" * len(batch))
+            cur.execute(f"SELECT id, content, metadata FROM documents WHERE id IN ({placeholders})", batch)
+            fetched.extend(cur.fetchall())
 
-    def search_keyword(self, query: str, k: int = 10, subject: Optional[str] = None) -> List[Dict]:
+        with self._cache_lock:
+            for row in fetched:
+                doc = {"id": row[0], "content": row[1], "metadata": json.loads(row[2] or "{}")}
+                found[row[0]] = doc
+                self._cache[row[0]] = doc
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return found
+
+    def _match_keyword(self, columns: str, query: str, k: int, subject: Optional[str]) -> List[tuple]:
         cur = self.conn.cursor()
-        # FTS5 match
-        cur.execute("SELECT rowid, content, metadata FROM docs_fts WHERE docs_fts MATCH ? LIMIT ?", (query, k * 5)) # Fetch more for filtering
-        rows = cur.fetchall()
-        results = []
-        for r in rows:
-            meta = json.loads(r[2] or "{}")
-            if subject and meta.get('subject', '').lower() != subject.lower():
-                continue
-            results.append({"id": r[0], "content": r[1], "metadata": meta})
-            if len(results) >= k:
-                break
-        return results
+        # FTS5 match ranked by BM25 (bm25() is lower-is-better); the subject filter runs in the
+        # same query so no overfetching is needed
+        sql = f"SELECT {columns}, bm25(docs_fts) AS score FROM docs_fts"
+        if subject:
+            sql += " JOIN documents ON documents.id = docs_fts.rowid"
+        sql += " WHERE docs_fts MATCH ?"
+        params = [query]
+        if subject:
+            sql += " AND documents.subject_key = ?"
+            params.append(subject_key(subject))
+        sql += " ORDER BY score LIMIT ?"
+        params.append(k)
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+    def search_keyword(self, query: str, k: int = 10, subject: Optional[str] = None) -> List[Dict]:
+        rows = self._match_keyword("docs_fts.rowid, docs_fts.content, docs_fts.metadata", query, k, subject)
+        # report relevance as higher-is-better, like the semantic scores
+        return [{"id": r[0], "score": -r[3], "content": r[1], "metadata": json.loads(r[2] or "{}")} for r in rows]
+
+    def search_keyword_ids(self, query: str, k: int = 10, subject: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Like search_keyword, but returns only (ids, scores) arrays, best first, without loading content."""
+        rows = self._match_keyword("docs_fts.rowid", query, k, subject)
+        ids = np.array([r[0] for r in rows], dtype=np.int64)
+        scores = np.array([-r[1] for r in rows], dtype=np.float64)
+        return ids, scores
 
     def list_documents(self, subject: Optional[str] = None) -> List[Dict]:
         cur = self.conn.cursor()
-        # We want to group by source_path or filename to avoid listing every chunk
-        # But for now, let's just return all unique files based on metadata
-        
-        # Fetch all docs
-        cur.execute("SELECT id, content, metadata FROM documents")
+        # Group chunks into files inside SQLite (by source_path, else filename) so only one row
+        # per file is returned and parsed. With MIN(id), SQLite returns the bare metadata column
+        # from the first chunk of each file.
+        where = "WHERE subject_key = ?" if subject else ""
+        cur.execute(f"""
+            SELECT MIN(id), metadata FROM documents
+            {where}
+            GROUP BY {FILE_KEY_SQL}
+            ORDER BY MIN(id)
+        """, (subject_key(subject),) if subject else ())
         rows = cur.fetchall()
         
-        # Group by filename/source_path
-        files_map = {}
-        
+        files = []
         for r in rows:
-            meta = json.loads(r[2] or "{}")
-            
-            # Filter by subject if provided
-            if subject:
-                doc_subject = meta.get('subject', '')
-                if doc_subject.lower() != subject.lower():
-                    continue
-            
+            meta = json.loads(r[1] or "{}")
             filename = meta.get('filename', 'unknown')
-            source_path = meta.get('source_path', filename)
-            
-            # Use source_path as key to identify unique files
-            if source_path not in files_map:
-                files_map[source_path] = {
-                    "id": r[0], # Use ID of the first chunk found
-                    "filename": filename,
-                    "subject": meta.get('subject', 'Uncategorized'),
-                    "type": os.path.splitext(filename)[1].replace('.', '') if filename != 'unknown' else 'txt',
-                    "size": "Unknown", # We don't store size currently
-                    "date": "Unknown", # We don't store date currently
-                    "metadata": meta
-                }
+            files.append({
+                "id": r[0], # Use ID of the first chunk found
+                "filename": filename,
+                "subject": meta.get('subject', 'Uncategorized'),
+                "type": os.path.splitext(filename)[1].replace('.', '') if filename != 'unknown' else 'txt',
+                "size": "Unknown", # We don't store size currently
+                "date": "Unknown", # We don't store date currently
+                "metadata": meta
+            })
         
-        return list(files_map.values())
+        return files
+
+    def subject_ids(self) -> Dict[str, np.ndarray]:
+        """Map subject_key(subject) -> int64 array of the ids of its chunks."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT subject_key, id FROM documents WHERE subject_key IS NOT NULL ORDER BY id")
+        grouped: Dict[str, List[int]] = {}
+        for key, doc_id in cur.fetchall():
+            grouped.setdefault(key, []).append(doc_id)
+        return {subject: np.asarray(ids, dtype='int64') for subject, ids in grouped.items()}
 
     def get_subjects(self) -> List[str]:
         cur = self.conn.cursor()
@@ -203,13 +447,30 @@ class DocumentStore:
 
 class FaissVectorStore:
     """
-    FAISS wrapper that persists index to disk and maps integer doc ids to FAISS ids via IndexIDMap.
-    Uses inner IndexFlatIP (dot product) and expects normalized vectors for cosine.
+    FAISS wrapper that persists index to disk and maps integer doc ids to FAISS ids via IndexIDMap2.
+    Uses an HNSW graph over inner product (expects normalized vectors for cosine) so searches are
+    sub-linear; once the corpus reaches ivfpq_threshold vectors the owner rebuilds it as IVF-PQ
+    (needs_rebuild / snapshot / build_ivfpq / swap_index, so training can run outside its locks).
+    Vectors are stored as 8-bit scalar codes (4x smaller than FP32); the quantizer is trained on
+    the first batch added and its ranges are persisted with the index.
+    Indexes written by older versions (IndexIDMap over IndexFlatIP) are migrated when loaded.
     """
 
-    def __init__(self, dim: int, index_path: str = "faiss.index"):
+    def __init__(self, dim: int, index_path: str = "faiss.index",
+                 hnsw_m: int = 32, ef_construction: int = 200,
+                 ivfpq_threshold: int = 100_000, nprobe: int = 16, nprobe_fraction: float = 0.1,
+                 min_train_size: int = 256, exact_filter_max: int = 2048):
         self.dim = dim
         self.index_path = index_path
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ivfpq_threshold = ivfpq_threshold
+        # IVF lists probed per query: nprobe_fraction of nlist (which grows as 4*sqrt(N)), at least nprobe
+        self.nprobe = nprobe
+        self.nprobe_fraction = nprobe_fraction
+        self.min_train_size = min_train_size
+        # filters with at most this many ids are scored exactly instead of walking the ANN index
+        self.exact_filter_max = exact_filter_max
         self._init_index()
 
     def _init_index(self):
@@ -219,34 +480,354 @@ class FaissVectorStore:
                 return
             except Exception as e:
                 print(f"Failed to load existing index: {e}. Creating new one.")
-        
-        quant = faiss.IndexFlatIP(self.dim)
-        # IndexIDMap allows us to use our own ids (doc ids)
-        self.index = faiss.IndexIDMap(quant)
+        self.index = self._new_hnsw_index()
+
+    def _new_hnsw_index(self):
+        base = faiss.IndexHNSWSQ(self.dim, faiss.ScalarQuantizer.QT_8bit, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        base.hnsw.efConstruction = self.ef_construction
+        # widen the per-dimension ranges seen during training so later vectors are not clipped
+        faiss.downcast_index(base.storage).sq.rangestat_arg = 0.2
+        # IndexIDMap2 allows us to use our own ids (doc ids) and reconstruct vectors by id
+        return faiss.IndexIDMap2(base)
+
+    def _base_index(self):
+        return faiss.downcast_index(self.index.index)
 
     def add(self, vectors: np.ndarray, ids: np.ndarray):
         assert vectors.shape[1] == self.dim
-        ids = ids.astype('int64')
+        # no-ops for the C-contiguous float32/int64 buffers FaissRAG passes in
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        ids = np.ascontiguousarray(ids, dtype='int64')
+        if not self.index.is_trained:
+            self._train(self.index, vectors)
         self.index.add_with_ids(vectors, ids)
 
-    def search(self, vectors: np.ndarray, k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
-        # returns (scores, ids)
-        scores, ids = self.index.search(vectors, k)
+    def _train(self, index, vectors: np.ndarray):
+        if len(vectors) < self.min_train_size:
+            # too few samples to estimate per-dimension ranges; unit vectors lie in [-1, 1]
+            vectors = np.vstack([vectors, -np.ones((1, self.dim), dtype='float32'),
+                                 np.ones((1, self.dim), dtype='float32')])
+        index.train(vectors)
+
+    def needs_rebuild(self) -> bool:
+        return self.index.ntotal >= self.ivfpq_threshold and isinstance(self._base_index(), faiss.IndexHNSW)
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(vectors, ids) of everything stored, in insertion order. Read-only, safe next to searches."""
+        return self._base_index().reconstruct_n(0, self.index.ntotal), self.ids()
+
+    def build_ivfpq(self, vectors: np.ndarray, ids: np.ndarray):
+        """
+        Build an IVF-PQ index (coarse quantizer with 4*sqrt(N) lists, 8-bit product codes) holding
+        the given vectors. Does not touch self.index, so the k-means/PQ training can run while the
+        current index keeps serving. Returns None if there are too few vectors to train it.
+        """
+        n = len(vectors)
+        nlist = int(4 * math.sqrt(n))
+        if n < nlist * 39:
+            # not enough points to train the coarse quantizer yet
+            return None
+
+        # number of sub-quantizers must divide dim; aim for ~4 dims per sub-vector
+        m = max(d for d in range(1, self.dim // 4 + 1) if self.dim % d == 0)
+        quant = faiss.IndexFlatIP(self.dim)
+        ivf = faiss.IndexIVFPQ(quant, self.dim, nlist, m, 8, faiss.METRIC_INNER_PRODUCT)
+        ivf.train(vectors)
+        ivf.make_direct_map() # lets IndexIDMap2 reconstruct vectors by id (exact filtered search)
+        index = faiss.IndexIDMap2(ivf)
+        index.add_with_ids(vectors, ids)
+        return index
+
+    def swap_index(self, index, n_snapshot: int):
+        """
+        Replace the index with one built from the first n_snapshot stored vectors, carrying over
+        vectors added since the snapshot. Callers must exclude concurrent adds and searches.
+        """
+        n = self.index.ntotal
+        if n > n_snapshot:
+            index.add_with_ids(self._base_index().reconstruct_n(n_snapshot, n - n_snapshot), self.ids()[n_snapshot:])
+        self.index = index
+
+    def _migrate_flat(self):
+        # indexes from older versions are exact IndexIDMap(IndexFlatIP); re-index their vectors
+        vectors, ids = self.snapshot()
+        index = self.build_ivfpq(vectors, ids) if len(ids) >= self.ivfpq_threshold else None
+        if index is None:
+            index = self._new_hnsw_index()
+            if len(ids):
+                self._train(index, vectors)
+                index.add_with_ids(vectors, ids)
+        self.index = index
+
+    def _search_params(self, k: int, selectivity: float = 1.0):
+        """
+        selectivity is the fraction of the index an id filter lets through. A filtered search only
+        keeps allowed ids among the candidates it visits, so the search is widened by 1/selectivity.
+        """
+        base = self._base_index()
+        if isinstance(base, faiss.IndexHNSW):
+            # efSearch bounds how many graph nodes are visited; keep it comfortably above k
+            ef = int(max(k * 4, 64) / selectivity)
+            return faiss.SearchParametersHNSW(efSearch=min(ef, max(self.index.ntotal, 64)))
+        if isinstance(base, faiss.IndexIVF):
+            nprobe = max(self.nprobe, int(base.nlist * self.nprobe_fraction))
+            return faiss.SearchParametersIVF(nprobe=min(int(math.ceil(nprobe / selectivity)), base.nlist))
+        return None
+
+    def _search_exact(self, vectors: np.ndarray, k: int, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # brute-force inner product over the (few) allowed vectors, in FAISS's (scores, ids) layout
+        nq = vectors.shape[0]
+        scores = np.full((nq, k), -np.inf, dtype='float32')
+        out_ids = np.full((nq, k), -1, dtype='int64')
+        if len(ids) == 0:
+            return scores, out_ids
+        sims = vectors @ self.index.reconstruct_batch(ids).T
+        top = np.argsort(-sims, axis=1, kind='stable')[:, :k]
+        n = top.shape[1]
+        scores[:, :n] = np.take_along_axis(sims, top, axis=1)
+        out_ids[:, :n] = ids[top]
+        return scores, out_ids
+
+    def search(self, vectors: np.ndarray, k: int = 10, allowed_ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (scores, ids). If allowed_ids is given, FAISS only scores those ids (IDSelectorBatch),
+        so filtered searches need no overfetching or post-filtering; small id sets are scored exactly,
+        since an approximate walk may visit too few of them to fill k.
+        """
+        if allowed_ids is None:
+            params = self._search_params(k)
+        else:
+            allowed_ids = np.ascontiguousarray(allowed_ids, dtype='int64')
+            # only IndexIDMap2 can reconstruct by id; legacy IndexIDMap indexes are flat (exact) anyway
+            if len(allowed_ids) <= self.exact_filter_max and isinstance(self.index, faiss.IndexIDMap2):
+                try:
+                    return self._search_exact(np.ascontiguousarray(vectors, dtype='float32'), k, allowed_ids)
+                except RuntimeError:
+                    pass # an id missing from the index; the selector below simply skips it
+            params = self._search_params(k, max(len(allowed_ids), 1) / max(self.index.ntotal, 1))
+            sel = faiss.IDSelectorBatch(len(allowed_ids), faiss.swig_ptr(allowed_ids))
+            if params is None:
+                params = faiss.SearchParameters()
+            params.sel = sel # sel must stay referenced until the search returns
+        if params is None:
+            return self.index.search(vectors, k)
+        scores, ids = self.index.search(vectors, k, params=params)
         return scores, ids
 
-    def save(self, path: Optional[str] = None):
+    def ids(self) -> np.ndarray:
+        """int64 array of every id stored in the index, in insertion order."""
+        return faiss.vector_to_array(self.index.id_map).astype('int64')
+
+    def serialize(self) -> np.ndarray:
+        """Snapshot of the index in faiss.write_index format (uint8 array), for writing out later."""
+        return faiss.serialize_index(self.index)
+
+    def save(self, path: Optional[str] = None, data: Optional[np.ndarray] = None):
+        """Write the index, or a snapshot taken earlier with serialize(), to path."""
         path = path or self.index_path
         ensure_dir(path)
-        faiss.write_index(self.index, path)
+        # write to a temp file and swap it in, so a crash mid-write never leaves a truncated index
+        tmp_path = path + ".tmp"
+        if data is None:
+            faiss.write_index(self.index, tmp_path)
+        else:
+            data.tofile(tmp_path)
+        os.replace(tmp_path, path)
 
     def load(self, path: Optional[str] = None):
         path = path or self.index_path
         if not os.path.exists(path):
             raise FileNotFoundError(path)
         self.index = faiss.read_index(path)
-        # make sure it's an IndexIDMap
-        if not isinstance(self.index, faiss.IndexIDMap):
+        # make sure it's an IndexIDMap (IndexIDMap2 for indexes written by this version)
+        if not isinstance(self.index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
             raise RuntimeError("Loaded index is not IndexIDMap")
+        base = self._base_index()
+        if isinstance(base, faiss.IndexFlat):
+            print(f"Migrating flat index at {path} ({self.index.ntotal} vectors) to HNSW/IVF-PQ...")
+            self._migrate_flat()
+            self.save(path)
+        elif isinstance(base, faiss.IndexIVF) and base.direct_map.type == faiss.DirectMap.NoMap:
+            base.make_direct_map()
+
+
+# --------------------------- ONNX embedder ---------------------------
+
+class OnnxEmbedder:
+    """
+    SentenceTransformer-compatible encoder backed by ONNX Runtime, for an exported (optionally
+    int8-quantized) model directory such as one produced by:
+        optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 minilm-onnx/
+        optimum-cli onnxruntime quantize --avx512_vnni --onnx_model minilm-onnx/ -o onnx-int8/
+    Pipeline per batch: tokenize -> session.run -> attention-masked mean pooling -> L2 normalize,
+    all in NumPy. Only encode() and the attributes FaissRAG uses are implemented.
+    """
+
+    def __init__(self, model_dir: str, max_seq_length: int = 256, num_threads: Optional[int] = None):
+        if ort is None or AutoTokenizer is None:
+            raise ImportError('onnxruntime and transformers are required for the ONNX embedder')
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_seq_length = max_seq_length
+
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = num_threads or os.cpu_count() or 1
+        opts.enable_cpu_mem_arena = True
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(self._find_model(model_dir), sess_options=opts,
+                                            providers=['CPUExecutionProvider'])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        outputs = [o.name for o in self.session.get_outputs()]
+        self._output_name = 'last_hidden_state' if 'last_hidden_state' in outputs else outputs[0]
+        self._dim = self.encode(["dimension probe"]).shape[1]
+
+    @staticmethod
+    def _find_model(model_dir: str) -> str:
+        # prefer the quantized graph when both are present
+        for name in ("model_quantized.onnx", "model.onnx"):
+            path = os.path.join(model_dir, name)
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError(f"No model_quantized.onnx or model.onnx in {model_dir}")
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dim
+
+    def encode(self, texts, batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, show_progress_bar: bool = False,
+               out: Optional[np.ndarray] = None) -> np.ndarray:
+        """out: optional C-contiguous float32 (len(texts), dim) buffer to write the embeddings into."""
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        embs = out
+        # longest first, so each batch pads to a similar length (as SentenceTransformer does)
+        order = np.argsort([-len(t) for t in texts], kind='stable')
+        for start in range(0, len(texts), batch_size):
+            idx = order[start:start + batch_size]
+            enc = self.tokenizer([texts[i] for i in idx], padding=True, truncation=True,
+                                 max_length=self.max_seq_length, return_tensors='np')
+            feeds = {name: enc[name].astype(np.int64) for name in ('input_ids', 'attention_mask', 'token_type_ids')
+                     if name in self._input_names and name in enc}
+            if 'token_type_ids' in self._input_names and 'token_type_ids' not in feeds:
+                feeds['token_type_ids'] = np.zeros_like(feeds['input_ids'])
+            hidden = self.session.run([self._output_name], feeds)[0]
+            mask = enc['attention_mask'].astype(np.float32)
+            pooled = np.einsum('bsd,bs->bd', hidden, mask)
+            pooled /= np.maximum(mask.sum(axis=1, keepdims=True), 1e-9)
+            if embs is None:
+                embs = np.empty((len(texts), pooled.shape[1]), dtype=np.float32)
+            embs[idx] = pooled
+        if embs is None:
+            embs = np.empty((0, self._dim), dtype=np.float32)
+        if normalize_embeddings and len(embs):
+            faiss.normalize_L2(embs) # in place
+        return embs[0] if single else embs
+
+
+# --------------------------- Embedding cache ---------------------------
+
+class EmbeddingCache:
+    """
+    Persistent content-hash -> embedding cache.
+    Each flush appends one shard: shard_<id>.npy (float32 vectors) plus shard_<id>.keys.npy
+    (16-byte blake2b digests of the texts). index.json lists the shards, the vector dim and the model id.
+    Vector shards are memory-mapped on load, so lookups read straight from the page cache.
+    Shards are merged tiered, like a binary counter: whenever the newest shard is at least as large
+    as the one before it, the two are merged. Shard sizes therefore halve from oldest to newest,
+    so there are O(log N) shards (open mappings) and every row is rewritten O(log N) times.
+    """
+
+    def __init__(self, cache_dir: str, dim: int, model_id: str = "", max_shards: int = 64):
+        self.cache_dir = cache_dir
+        self.dim = dim
+        self.model_id = model_id
+        # caches written by older versions may hold more shards; they are merged into one on load
+        self.max_shards = max_shards
+        self._index_path = os.path.join(cache_dir, "index.json")
+        self._shard_names: List[str] = []
+        self._shards: List[np.ndarray] = []
+        self._shard_keys: List[np.ndarray] = [] # (n, 16) uint8 digests per shard
+        self._entries: Dict[bytes, Tuple[int, int]] = {} # key -> (shard, row)
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def _load(self):
+        if not os.path.exists(self._index_path):
+            return
+        try:
+            with open(self._index_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('dim') != self.dim or meta.get('model', '') != self.model_id:
+                return # written by a different embedding model
+            for name in meta['shards']:
+                self._attach_shard(name)
+        except Exception as e:
+            print(f"Failed to load embedding cache: {e}. Starting empty.")
+            self._shard_names, self._shards, self._shard_keys, self._entries = [], [], [], {}
+            return
+        if len(self._shards) > self.max_shards:
+            self._merge_tail(len(self._shards))
+
+    def _attach_shard(self, name: str):
+        shard_no = len(self._shards)
+        keys = np.load(os.path.join(self.cache_dir, name + ".keys.npy"))
+        self._shards.append(np.load(os.path.join(self.cache_dir, name + ".npy"), mmap_mode='r'))
+        self._shard_keys.append(keys)
+        self._shard_names.append(name)
+        for row, key in enumerate(keys):
+            self._entries[key.tobytes()] = (shard_no, row)
+
+    def get_many(self, keys: List[bytes]) -> List[Optional[np.ndarray]]:
+        with self._lock:
+            hits = [self._entries.get(k) for k in keys]
+            return [self._shards[h[0]][h[1]] if h else None for h in hits]
+
+    def put_many(self, keys: List[bytes], vectors: np.ndarray):
+        with self._lock:
+            new_rows = {}
+            for i, k in enumerate(keys):
+                if k not in self._entries and k not in new_rows:
+                    new_rows[k] = i
+            if not new_rows:
+                return
+            key_array = np.frombuffer(b"".join(new_rows.keys()), dtype=np.uint8).reshape(-1, 16)
+            self._write_shard(key_array, vectors[list(new_rows.values())])
+            while len(self._shards) >= 2 and len(self._shards[-1]) >= len(self._shards[-2]):
+                self._merge_tail(2)
+
+    def _write_shard(self, keys: np.ndarray, vectors: np.ndarray):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        name = f"shard_{uuid.uuid4().hex[:12]}"
+        np.save(os.path.join(self.cache_dir, name + ".npy"), np.ascontiguousarray(vectors, dtype=np.float32))
+        np.save(os.path.join(self.cache_dir, name + ".keys.npy"), keys)
+        self._attach_shard(name)
+        self._write_index()
+
+    def _write_index(self):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"dim": self.dim, "model": self.model_id, "shards": self._shard_names}, f)
+        os.replace(tmp_path, self._index_path)
+
+    def _merge_tail(self, count: int):
+        # merge the newest `count` shards into one; keys are unique across shards, so rows just concatenate
+        first = len(self._shards) - count
+        vectors = np.concatenate(self._shards[first:])
+        keys = np.concatenate(self._shard_keys[first:])
+        old_names = self._shard_names[first:]
+        del self._shards[first:], self._shard_keys[first:], self._shard_names[first:]
+        # re-points every merged key at the new shard
+        self._write_shard(keys, vectors)
+        for old in old_names:
+            for suffix in (".npy", ".keys.npy"):
+                try:
+                    os.remove(os.path.join(self.cache_dir, old + suffix))
+                except OSError:
+                    pass
 
 
 # --------------------------- Extractors ---------------------------
@@ -255,46 +836,90 @@ class Extractor:
     @staticmethod
     def from_file(path: str) -> str:
         ext = os.path.splitext(path)[1].lower()
+        return Extractor._extract(path, ext)
+
+    @staticmethod
+    def iter_pages(source, ext: Optional[str] = None) -> Iterator[str]:
+        """
+        Lazily yield the text of a document piece by piece; "".join() of the pieces equals from_file().
+        PDFs are parsed one page at a time, other formats are yielded whole.
+        source is a path or a binary file object (then ext is required).
+        """
+        ext = (ext or os.path.splitext(source)[1]).lower()
+        if ext in {'.pdf'}:
+            return Extractor._iter_pdf(source)
+        return iter([Extractor._extract(source, ext)])
+
+    @staticmethod
+    def extract_with_head(source, head_chars: int = 2000, ext: Optional[str] = None) -> Tuple[str, Iterator[str]]:
+        """
+        Read only as many pages as needed for the first head_chars characters (e.g. for metadata
+        generation) and return them together with a lazy iterator over the rest of the text,
+        so head + "".join(rest) is the full text and the document is parsed once.
+        """
+        pages = Extractor.iter_pages(source, ext)
+        head = ""
+        for page in pages:
+            head += page
+            if len(head) >= head_chars:
+                break
+        overflow = head[head_chars:]
+        rest = itertools.chain([overflow], pages) if overflow else pages
+        return head[:head_chars], rest
+
+    @staticmethod
+    def _extract(source, ext: str) -> str:
+        # source is a path or a binary file-like object; every parser below accepts both
         if ext in {'.txt', '.md'}:
-            return Extractor._from_text(path)
+            return Extractor._from_text(source)
         if ext in {'.pdf'}:
-            return Extractor._from_pdf(path)
+            return Extractor._from_pdf(source)
         if ext in {'.docx'}:
-            return Extractor._from_docx(path)
+            return Extractor._from_docx(source)
         if ext in {'.pptx'}:
-            return Extractor._from_pptx(path)
+            return Extractor._from_pptx(source)
         raise ValueError(f"Unsupported file type: {ext}")
 
     @staticmethod
-    def _from_text(path: str) -> str:
-        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-            return f.read()
+    def _from_text(source) -> str:
+        if isinstance(source, str):
+            with open(source, 'r', encoding='utf-8', errors='ignore') as f:
+                return f.read()
+        data = source.read()
+        return data.decode('utf-8', errors='ignore') if isinstance(data, bytes) else data
 
     @staticmethod
-    def _from_pdf(path: str) -> str:
+    def _from_pdf(source) -> str:
+        return "".join(Extractor._iter_pdf(source))
+
+    @staticmethod
+    def _iter_pdf(source) -> Iterator[str]:
         if pdfplumber is None:
             raise ImportError('pdfplumber required to extract PDF text')
-        text_parts = []
-        with pdfplumber.open(path) as pdf:
+        first = True
+        with pdfplumber.open(source) as pdf:
             for page in pdf.pages:
                 txt = page.extract_text()
+                # drop parsed layout objects so only one page is held in memory
+                page.flush_cache()
                 if txt:
-                    text_parts.append(txt)
-        return "\n".join(text_parts)
+                    # separator goes in front so the pieces join exactly like "\n".join(pages)
+                    yield txt if first else "\n" + txt
+                    first = False
 
     @staticmethod
-    def _from_docx(path: str) -> str:
+    def _from_docx(source) -> str:
         if docx is None:
             raise ImportError('python-docx required to extract DOCX text')
-        doc = docx.Document(path)
+        doc = docx.Document(source)
         paragraphs = [p.text for p in doc.paragraphs if p.text]
         return "\n".join(paragraphs)
 
     @staticmethod
-    def _from_pptx(path: str) -> str:
+    def _from_pptx(source) -> str:
         if Presentation is None:
             raise ImportError('python-pptx required to extract PPTX text')
-        prs = Presentation(path)
+        prs = Presentation(source)
         slides_text = []
         for slide in prs.slides:
             for shape in slide.shapes:
@@ -307,165 +932,540 @@ class Extractor:
 
 # --------------------------- Main RAG class ---------------------------
 
+@dataclass
+class PendingChunk:
+    """A chunk waiting in the ingest queue for the background embedder."""
+    text: str
+    metadata: Dict
+    job_id: str
+
+
+# how many finished/pending ingest jobs to remember for status lookups
+MAX_TRACKED_JOBS = 1024
+# how many query embeddings to keep (LRU), persisted next to the index
+QUERY_CACHE_SIZE = 1024
+# rank offset for Reciprocal Rank Fusion in hybrid_search (the constant from the original RRF paper)
+RRF_K = 60
+
+
+def _configure_threads() -> int:
+    """
+    Split the cores between the embedder and FAISS so their OpenMP pools do not oversubscribe
+    the CPU. Returns the per-pool thread budget.
+    """
+    n_threads = max(1, (os.cpu_count() or 1) // 2)
+    faiss.omp_set_num_threads(n_threads)
+    if torch is not None:
+        torch.set_num_threads(n_threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # only settable before torch runs any parallel work (e.g. another FaissRAG already did)
+            pass
+    return n_threads
+
 class FaissRAG:
     def __init__(self,
                  db_path: str = "faiss_rag.db",
                  index_path: str = "faiss.index",
                  embedding_model_name: str = "all-MiniLM-L6-v2",
-                 batch_size: int = 64):
-        if SentenceTransformer is None:
+                 batch_size: int = 64,
+                 save_interval: float = 5.0,
+                 onnx_model_dir: Optional[str] = None):
+        """
+        onnx_model_dir: directory with an ONNX export of the embedding model (see OnnxEmbedder);
+        when given it replaces the PyTorch SentenceTransformer for both ingestion and queries.
+        """
+        if onnx_model_dir is None and SentenceTransformer is None:
             raise ImportError('sentence-transformers is required for default embedding model')
         self.docstore = DocumentStore(db_path)
-        self.embedder = SentenceTransformer(embedding_model_name)
+        n_threads = _configure_threads()
+        if onnx_model_dir:
+            self.embedder = OnnxEmbedder(onnx_model_dir, num_threads=n_threads)
+        else:
+            self.embedder = SentenceTransformer(embedding_model_name)
+            self.embedder.eval()
+        # identifies the embedding space in the on-disk embedding caches
+        self.model_id = f"onnx:{os.path.basename(os.path.normpath(onnx_model_dir))}" if onnx_model_dir else embedding_model_name
         self.dim = self.embedder.get_sentence_embedding_dimension()
         self.vstore = FaissVectorStore(dim=self.dim, index_path=index_path)
         self.index_path = index_path
         self.batch_size = batch_size
+        # chunk on the embedder's own tokens so chunks fit its sequence limit (needs offset mapping)
+        # (a private copy: HF fast tokenizers keep truncation/padding state per call, so sharing the
+        # embedder's instance would race with encode() running in the ingest worker thread)
+        tokenizer = getattr(self.embedder, 'tokenizer', None)
+        self.tokenizer = copy.deepcopy(tokenizer) if getattr(tokenizer, 'is_fast', False) else None
+        self.chunk_tokens = min(200, self.embedder.max_seq_length - 2)
+        # FAISS adds/rebuilds (with the matching SQLite insert) take it exclusively; searches and
+        # index snapshots share it, so concurrent queries run in parallel
+        self._index_lock = RWLock()
+        # serializes writing snapshots to disk
+        self._save_lock = threading.Lock()
+        # held while an IVF-PQ rebuild trains outside the index lock
+        self._rebuild_lock = threading.Lock()
+        # reusable ingest buffers, so steady-state batches embed and index without new (n, dim) arrays;
+        # several encode batches per buffer-full keep encode's length sorting effective for bulk adds
+        self._emb_buf = np.empty((batch_size * 16, self.dim), dtype=np.float32)
+        self._id_buf = np.empty(batch_size * 16, dtype=np.int64)
+        self._buf_lock = threading.Lock()
+        # async ingestion state, created by start_ingest_worker() inside the running event loop
+        self._ingest_queue: Optional[asyncio.Queue] = None
+        self._ingest_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._jobs: "OrderedDict[str, Dict]" = OrderedDict()
+        # query text hash -> normalized query embedding
+        self._query_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        self._query_cache_path = index_path + ".queries.npz"
+        self._query_cache_dirty = False
+        self._load_query_cache()
+        # chunk text hash -> embedding, persisted across restarts
+        self._emb_cache = EmbeddingCache(index_path + ".embcache", self.dim, self.model_id)
+        # index writes are debounced: adds mark the index dirty, saves happen at most every save_interval
+        self.save_interval = save_interval
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self._save_task: Optional[asyncio.Task] = None
+        atexit.register(self.flush)
+        # subject_key(subject) -> ids of its chunks, used to restrict FAISS searches by subject
+        self._subject_ids: Dict[str, np.ndarray] = self._load_subject_ids()
 
     # ---------------- Ingestion ----------------
     def add_files(self, paths: Iterable[str], metadata: Optional[Dict] = None) -> List[int]:
-        ids = []
+        all_chunks: List[str] = []
+        all_meta: List[Dict] = []
         for p in paths:
-            try:
-                txt = Extractor.from_file(p)
-            except Exception as e:
-                print(f"Error extracting from {p}: {e}")
-                continue
-                
-            chunks = chunk_text(txt)
-            
             base_meta = metadata.copy() if metadata else {}
             base_meta['source_path'] = p
             if 'filename' not in base_meta:
                 base_meta['filename'] = os.path.basename(p)
-            
-            for i, chunk in enumerate(chunks):
-                meta = base_meta.copy()
-                meta['chunk_index'] = i
-                doc_id = self.docstore.add(chunk, meta)
-                ids.append(doc_id)
-                
-        # embed and add newly added docs
-        self._index_new_docs(ids)
-        self.save() # Auto-save after adding
+
+            # pages are extracted lazily and chunked as they arrive
+            try:
+                chunks, metas = self._prepare_chunks(Extractor.iter_pages(p), base_meta)
+            except Exception as e:
+                print(f"Error extracting from {p}: {e}")
+                continue
+            all_chunks.extend(chunks)
+            all_meta.extend(metas)
+
+        # embed every chunk of every file together (a buffer-full per encode call), then index
+        ids = self._index_chunks(all_chunks, all_meta)
+        self._maybe_save()
         return ids
 
     def add_text(self, text: str, metadata: Optional[Dict] = None) -> List[int]:
-        chunks = chunk_text(text)
-        ids = []
-        for i, chunk in enumerate(chunks):
+        chunks, metas = self._prepare_chunks(text, metadata)
+        ids = self._index_chunks(chunks, metas)
+        self._maybe_save()
+        return ids
+
+    def _prepare_chunks(self, text: Union[str, Iterable[str]], metadata: Optional[Dict] = None) -> Tuple[List[str], List[Dict]]:
+        chunks = []
+        metas = []
+        for chunk, meta in self._iter_chunks_with_meta(text, metadata):
+            chunks.append(chunk)
+            metas.append(meta)
+        return chunks, metas
+
+    def _iter_chunks_with_meta(self, text: Union[str, Iterable[str]], metadata: Optional[Dict] = None) -> Iterator[Tuple[str, Dict]]:
+        for i, chunk in enumerate(iter_chunks(text, tokenizer=self.tokenizer, chunk_tokens=self.chunk_tokens)):
             meta = metadata.copy() if metadata else {}
             meta['chunk_index'] = i
-            doc_id = self.docstore.add(chunk, meta)
-            ids.append(doc_id)
-            
-        self._index_new_docs(ids)
-        self.save() # Auto-save after adding
+            yield chunk, meta
+
+    def _index_chunks(self, chunks: List[str], metas: List[Dict]) -> List[int]:
+        """
+        Embed chunks into the preallocated buffer (one encoder call per buffer-full), then store
+        them in SQLite and FAISS. Each slice is embedded before it is stored, so a failing encode
+        does not leave unindexed rows behind.
+        """
+        ids = []
+        with self._buf_lock:
+            for start in range(0, len(chunks), len(self._emb_buf)):
+                batch = chunks[start:start + len(self._emb_buf)]
+                batch_metas = metas[start:start + len(batch)]
+                embeddings = self._embed_chunks(batch, out=self._emb_buf[:len(batch)])
+                with self._index_lock.write():
+                    batch_ids = self.docstore.add_many([(chunk, json.dumps(meta)) for chunk, meta in zip(batch, batch_metas)])
+                    id_buf = self._id_buf[:len(batch)]
+                    id_buf[:] = batch_ids
+                    self.vstore.add(embeddings, id_buf)
+                    self._dirty = True
+                    self._track_subjects(batch_ids, batch_metas)
+                ids.extend(batch_ids)
+        if self.vstore.needs_rebuild():
+            self._rebuild_index()
         return ids
 
-    def _index_new_docs(self, doc_ids: List[int]):
-        # fetch text for doc_ids, embed in batches, add to FAISS
-        if not doc_ids:
+    def _rebuild_index(self):
+        """
+        Switch the grown HNSW index to IVF-PQ. Only the snapshot (shared lock, searches continue)
+        and the final swap (exclusive) hold the index lock; k-means/PQ training runs without it.
+        """
+        if not self._rebuild_lock.acquire(blocking=False):
+            return # another thread is already rebuilding
+        try:
+            with self._index_lock.read():
+                if not self.vstore.needs_rebuild():
+                    return
+                vectors, ids = self.vstore.snapshot()
+            index = self.vstore.build_ivfpq(vectors, ids)
+            if index is None:
+                return
+            with self._index_lock.write():
+                self.vstore.swap_index(index, len(ids))
+                self._dirty = True
+        finally:
+            self._rebuild_lock.release()
+
+    def _load_subject_ids(self) -> Dict[str, np.ndarray]:
+        # SQLite can hold chunks the index lacks (e.g. a crash before the debounced save),
+        # so keep only ids FAISS can actually score
+        indexed = self.vstore.ids()
+        return {subject: ids[np.isin(ids, indexed)] for subject, ids in self.docstore.subject_ids().items()}
+
+    def _track_subjects(self, ids: List[int], metas: List[Dict]):
+        new_ids: Dict[str, List[int]] = {}
+        for doc_id, meta in zip(ids, metas):
+            if meta.get('subject') is not None:
+                new_ids.setdefault(subject_key(meta['subject']), []).append(doc_id)
+        for subject, subject_ids in new_ids.items():
+            added = np.asarray(subject_ids, dtype='int64')
+            existing = self._subject_ids.get(subject)
+            # replace (not mutate) the array so concurrent searches see a consistent snapshot
+            self._subject_ids[subject] = added if existing is None else np.concatenate([existing, added])
+
+    # ---------------- Async ingestion ----------------
+    def start_ingest_worker(self, maxsize: int = 256):
+        """
+        Create the bounded ingest queue and start the background embedder task.
+        Must be called from within the running event loop (e.g. a FastAPI startup handler).
+        """
+        if self._ingest_task is not None and not self._ingest_task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._ingest_queue = asyncio.Queue(maxsize=maxsize)
+        self._ingest_task = asyncio.create_task(self._embed_worker())
+
+    async def stop_ingest_worker(self):
+        """Wait for queued chunks to be indexed, then stop the embedder task."""
+        if self._ingest_task is None:
             return
-        batches = [doc_ids[i:i+self.batch_size] for i in range(0, len(doc_ids), self.batch_size)]
-        for batch in batches:
-            texts = [self.docstore.get(d)['content'] for d in batch]
-            embeddings = self._embed_texts(texts)
-            embeddings = normalize_embeddings(embeddings)
-            ids = np.array(batch).astype('int64')
-            self.vstore.add(embeddings, ids)
-
-    def _embed_texts(self, texts: List[str]) -> np.ndarray:
-        # sentence-transformers supports batching in encode
-        embs = self.embedder.encode(texts, batch_size=self.batch_size, convert_to_numpy=True, show_progress_bar=False)
+        await self._ingest_queue.join()
+        self._ingest_task.cancel()
+        try:
+            await self._ingest_task
+        except asyncio.CancelledError:
+            pass
+        self._ingest_task = None
+        self._loop = None
+        if self._save_task is not None:
+            self._save_task.cancel()
+            self._save_task = None
+
+    def open_job(self) -> str:
+        job_id = uuid.uuid4().hex
+        self._jobs[job_id] = {"job_id": job_id, "queued": 0, "indexed": 0, "closed": False, "error": None}
+        while len(self._jobs) > MAX_TRACKED_JOBS:
+            self._jobs.popitem(last=False)
+        return job_id
+
+    def close_job(self, job_id: str):
+        """Mark a job as fully enqueued; it reports 'done' once every chunk is indexed."""
+        job = self._jobs.get(job_id)
+        if job:
+            job['closed'] = True
+
+    def fail_job(self, job_id: str, error: str):
+        """Record an error that happened while enqueueing (e.g. a page that failed to parse)."""
+        job = self._jobs.get(job_id)
+        if job:
+            job['error'] = error if not job['error'] else f"{job['error']}; {error}"
+
+    def job_status(self, job_id: str) -> Optional[Dict]:
+        job = self._jobs.get(job_id)
+        if not job:
+            return None
+        if job['error']:
+            status = "failed"
+        elif job['closed'] and job['indexed'] >= job['queued']:
+            status = "done"
+        else:
+            status = "pending"
+        return {"job_id": job_id, "status": status, "queued": job['queued'],
+                "indexed": job['indexed'], "error": job['error']}
+
+    async def enqueue_text(self, job_id: str, text: Union[str, Iterable[str]], metadata: Optional[Dict] = None) -> int:
+        """
+        Chunk text and put the chunks on the ingest queue. Returns as soon as the chunks are queued
+        (waiting only if the queue is full); embedding happens in the background worker.
+        text may be a lazy iterator of pages (see Extractor.extract_with_head); chunks are queued as
+        pages are parsed, so the whole document is never held in memory.
+        """
+        if self._ingest_queue is None:
+            raise RuntimeError("Ingest worker not started. Call start_ingest_worker() first.")
+        items = self._iter_chunks_with_meta(text, metadata)
+        job = self._jobs[job_id]
+        count = 0
+        while True:
+            # pulling the next chunk may parse a PDF page, so keep it off the event loop
+            item = await asyncio.to_thread(next, items, None)
+            if item is None:
+                break
+            chunk, meta = item
+            job['queued'] += 1
+            await self._ingest_queue.put(PendingChunk(chunk, meta, job_id))
+            count += 1
+        return count
+
+    async def _embed_worker(self, max_wait: float = 0.1):
+        """
+        Drain the ingest queue in micro-batches: flush when batch_size chunks are collected
+        or max_wait seconds after the first chunk of the batch arrived.
+        """
+        queue = self._ingest_queue
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + max_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                # encode releases the GIL, so the event loop keeps serving requests meanwhile
+                await asyncio.to_thread(self._index_chunks, [c.text for c in batch], [c.metadata for c in batch])
+                self._maybe_save()
+                for c in batch:
+                    job = self._jobs.get(c.job_id)
+                    if job:
+                        job['indexed'] += 1
+            except Exception as e:
+                print(f"Error indexing queued chunks: {e}")
+                for c in batch:
+                    job = self._jobs.get(c.job_id)
+                    if job:
+                        job['error'] = str(e)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    def _embed_texts(self, texts: List[str], out: Optional[np.ndarray] = None) -> np.ndarray:
+        if out is not None and isinstance(self.embedder, OnnxEmbedder):
+            # ONNX path pools and normalizes in place inside the caller's buffer
+            return self.embedder.encode(texts, batch_size=self.batch_size, normalize_embeddings=True, out=out)
+        # sentence-transformers supports batching in encode; it also L2-normalizes rows for cosine (dot product).
+        # inference_mode skips the autograd bookkeeping that encode's no_grad still does
+        no_autograd = torch.inference_mode() if torch is not None else contextlib.nullcontext()
+        with no_autograd:
+            embs = self.embedder.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                        normalize_embeddings=True, show_progress_bar=False)
         if embs.ndim == 1:
             embs = np.expand_dims(embs, 0)
+        if out is not None:
+            out[:] = embs
+            return out
+        return embs
+
+    def _embed_chunks(self, texts: List[str], out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Embed document chunks through the persistent cache: only texts never seen before
+        (deduplicated by content hash) reach the encoder; results are stitched back in input order.
+        If out (len(texts), dim) float32 is given, the embeddings are written into it.
+        """
+        keys = [EmbeddingCache.key(t) for t in texts]
+        embs = out if out is not None else np.empty((len(texts), self.dim), dtype=np.float32)
+        misses: "OrderedDict[bytes, List[int]]" = OrderedDict()
+        for i, (key, vec) in enumerate(zip(keys, self._emb_cache.get_many(keys))):
+            if vec is None:
+                misses.setdefault(key, []).append(i)
+            else:
+                embs[i] = vec
+        if misses:
+            miss_keys = list(misses.keys())
+            miss_texts = [texts[misses[k][0]] for k in miss_keys]
+            if len(miss_keys) == len(texts):
+                # nothing cached and no duplicates: encode straight into the output rows
+                new_embs = self._embed_texts(miss_texts, out=embs)
+            else:
+                new_embs = self._embed_texts(miss_texts)
+                for key, vec in zip(miss_keys, new_embs):
+                    embs[misses[key]] = vec
+            self._emb_cache.put_many(miss_keys, new_embs)
         return embs
 
+    def _embed_query(self, query: str) -> np.ndarray:
+        """Embed a single query, reusing the cached vector for repeated queries."""
+        key = hashlib.blake2b(query.encode('utf-8'), digest_size=16).digest()
+        with self._query_cache_lock:
+            emb = self._query_cache.get(key)
+            if emb is not None:
+                self._query_cache.move_to_end(key)
+                return emb
+        emb = self._embed_texts([query])
+        with self._query_cache_lock:
+            self._query_cache[key] = emb
+            self._query_cache_dirty = True
+            while len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return emb
+
+    def _load_query_cache(self):
+        if not os.path.exists(self._query_cache_path):
+            return
+        try:
+            data = np.load(self._query_cache_path)
+            keys, vecs = data['keys'], data['vecs']
+            model_id = str(data['model']) if 'model' in data.files else ""
+        except Exception as e:
+            print(f"Failed to load query cache: {e}")
+            return
+        if vecs.ndim != 2 or vecs.shape[1] != self.dim or model_id != self.model_id:
+            return # cache from a different embedding model
+        for key, vec in zip(keys, vecs):
+            self._query_cache[key.tobytes()] = vec[None, :]
+
+    def _save_query_cache(self):
+        with self._query_cache_lock:
+            if not self._query_cache_dirty:
+                return
+            self._query_cache_dirty = False
+            keys = np.frombuffer(b"".join(self._query_cache.keys()), dtype=np.uint8).reshape(-1, 16)
+            vecs = np.vstack(list(self._query_cache.values()))
+        ensure_dir(self._query_cache_path)
+        tmp_path = self._query_cache_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, keys=keys, vecs=vecs, model=np.array(self.model_id))
+        os.replace(tmp_path, self._query_cache_path)
+
     # ---------------- Persistence ----------------
     def save(self):
-        self.vstore.save(self.index_path)
+        with self._save_lock:
+            # snapshot in memory, then write it out without blocking adds (or searches) on disk I/O
+            with self._index_lock.read():
+                data = self.vstore.serialize()
+                self._dirty = False
+                self._last_save = time.monotonic()
+            self.vstore.save(self.index_path, data=data)
+        self._save_query_cache()
+
+    def flush(self):
+        """Save now if there are unsaved changes (used at shutdown/exit)."""
+        if self._dirty:
+            self.save()
+        else:
+            # a process that only answers queries still persists its query embeddings
+            self._save_query_cache()
+
+    def _maybe_save(self):
+        """
+        Debounced save after an ingest: writes immediately if the last save is older than
+        save_interval, otherwise (inside an event loop) schedules one deferred save.
+        From a worker thread while the ingest worker runs, the deferred save is scheduled on its loop;
+        otherwise a skipped save is picked up by the next add or by flush() at exit.
+        """
+        if not self._dirty:
+            return
+        wait = self.save_interval - (time.monotonic() - self._last_save)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if wait <= 0:
+                self.save()
+            elif self._loop is not None and not self._loop.is_closed():
+                # e.g. add_text run via asyncio.to_thread: let the server's loop debounce it
+                self._loop.call_soon_threadsafe(self._maybe_save)
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self._delayed_save(max(wait, 0.0)))
+
+    async def _delayed_save(self, delay: float):
+        await asyncio.sleep(delay)
+        if self._dirty:
+            # writing the index blocks, keep it off the event loop
+            await asyncio.to_thread(self.save)
 
     def load(self):
-        self.vstore.load(self.index_path)
+        with self._index_lock.write():
+            self.vstore.load(self.index_path)
+            self._subject_ids = self._load_subject_ids()
 
     # ---------------- Search ----------------
     def search_similarity(self, query: str, k: int = 5, subject: Optional[str] = None) -> List[Dict]:
-        q_emb = self._embed_texts([query])
-        q_emb = normalize_embeddings(q_emb)
-        
-        # Fetch more candidates if filtering to avoid missing relevant docs
-        # If subject is provided, we need to fetch enough to likely find matches
-        fetch_k = max(k * 10, 100) if subject else k
-        
-        scores, ids = self.vstore.search(q_emb, fetch_k)
+        ids, scores = self._search_similarity_ids(query, k, subject)
+        docs = self.docstore.get_many(ids.tolist())
         
         results = []
-        for i, doc_id in enumerate(ids[0]):
-            if doc_id == -1:
-                continue
-            doc = self.docstore.get(int(doc_id))
+        for doc_id, score in zip(ids.tolist(), scores.tolist()):
+            doc = docs.get(doc_id)
             if not doc:
                 continue
             
-            # Filter by subject if provided
-            if subject:
-                doc_subject = doc['metadata'].get('subject', '')
-                # Case-insensitive comparison
-                if doc_subject.lower() != subject.lower():
-                    continue
-            
             results.append({
-                "id": int(doc_id),
-                "score": float(scores[0][i]),
+                "id": doc_id,
+                "score": score,
                 "content": doc['content'],
                 "metadata": doc['metadata']
             })
-            
-            if len(results) >= k:
-                break
                 
         return results
 
+    def _search_similarity_ids(self, query: str, k: int, subject: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Semantic search returning only (ids, scores) arrays, best first."""
+        q_emb = self._embed_query(query)
+        
+        # Subject filtering happens inside FAISS: only that subject's ids are scored (case-insensitive)
+        allowed_ids = None
+        if subject:
+            allowed_ids = self._subject_ids.get(subject_key(subject))
+            if allowed_ids is None:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        
+        # FAISS does not allow searching while another thread adds to the index
+        with self._index_lock.read():
+            scores, ids = self.vstore.search(q_emb, k, allowed_ids=allowed_ids)
+        found = ids[0] != -1
+        return ids[0][found].astype(np.int64), scores[0][found]
+
     def search_keyword(self, query: str, k: int = 5, subject: Optional[str] = None) -> List[Dict]:
         # simple wrapper around sqlite FTS5
         return self.docstore.search_keyword(query, k, subject)
 
     def hybrid_search(self, query: str, k: int = 10, alpha: float = 0.5, subject: Optional[str] = None) -> List[Dict]:
         """
-        Hybrid search: run both keyword (FTS) and vector similarity and merge results.
-        alpha: weight for semantic score (0..1). Final score = alpha * semantic + (1-alpha) * keyword_score
-        Keyword score is approximated using FTS rank ordering (we convert rank -> score)
+        Hybrid search: run both keyword (FTS5/BM25) and vector similarity and merge results
+        with weighted Reciprocal Rank Fusion:
+            score = alpha / (RRF_K + rank_semantic) + (1 - alpha) / (RRF_K + rank_keyword)
+        with 1-based ranks; a list a document does not appear in contributes nothing.
+        alpha: weight for the semantic list (0..1); 0.5 is plain RRF.
+        Fusing ranks avoids mixing cosine and BM25 scores, whose magnitudes are not comparable.
+        Only the semantic leg embeds the query, and that embedding is served from the query cache on repeats.
         """
-        semantic = self.search_similarity(query, k, subject=subject)
-        keyword = self.search_keyword(query, k, subject=subject)
+        sem_ids, sem_scores = self._search_similarity_ids(query, k, subject)
+        kw_ids, kw_scores = self.docstore.search_keyword_ids(query, k, subject)
+        
+        # fuse on ids/ranks only; content is loaded just for the k results that survive
+        ids, scores, sem_pos, kw_pos = _rrf_fuse(sem_ids, kw_ids, float(alpha), RRF_K)
+        ids, scores, sem_pos, kw_pos = ids[:k].tolist(), scores[:k].tolist(), sem_pos[:k].tolist(), kw_pos[:k].tolist()
+        docs = self.docstore.get_many(ids)
         
-        # convert keyword list to dict of id->score (simple decreasing score)
-        kw_scores = {}
-        for rank, item in enumerate(keyword):
-            # higher rank -> higher score
-            kw_scores[item['id']] = 1.0 / (1 + rank)
-            
-        merged = {}
-        for item in semantic:
-            merged[int(item['id'])] = {'id': int(item['id']), 'semantic': item['score'], 'content': item['content'], 'metadata': item['metadata']}
-            
-        for item in keyword:
-            did = int(item['id'])
-            if did in merged:
-                merged[did]['keyword'] = kw_scores[did]
-            else:
-                merged[did] = {'id': did, 'semantic': 0.0, 'keyword': kw_scores[did], 'content': item['content'], 'metadata': item['metadata']}
-                
         results = []
-        for v in merged.values():
-            s_sem = v.get('semantic', 0.0)
-            s_kw = v.get('keyword', 0.0)
-            final = alpha * s_sem + (1 - alpha) * s_kw
-            results.append({'id': v['id'], 'score': float(final), 'semantic': float(s_sem), 'keyword': float(s_kw), 'content': v['content'], 'metadata': v['metadata']})
-            
-        results = sorted(results, key=lambda x: x['score'], reverse=True)
-        return results[:k]
+        for doc_id, score, sp, kp in zip(ids, scores, sem_pos, kw_pos):
+            doc = docs.get(doc_id)
+            if not doc:
+                continue
+            results.append({'id': doc_id, 'score': score,
+                            'semantic': float(sem_scores[sp]) if sp >= 0 else 0.0,
+                            'keyword': float(kw_scores[kp]) if kp >= 0 else 0.0,
+                            'content': doc['content'], 'metadata': doc['metadata']})
+        return results
 
     def list_documents(self, subject: Optional[str] = None) -> List[Dict]:
         return self.docstore.list_documents(subject)
@@ -1,10 +1,9 @@
 import os
+import time
 import shutil
 from fastapi.testclient import TestClient
 from main import app, rag
 
-client = TestClient(app)
-
 def test_gemini_upload():
     # Create a dummy file
     filename = "test_physics_new.txt"
@@ -13,25 +12,36 @@ def test_gemini_upload():
         f.write(content)
     
     try:
-        # Upload the file without subject
-        with open(filename, "rb") as f:
-            response = client.post(
-                "/upload",
-                files={"files": (filename, f, "text/plain")}
-            )
-        
-        print("Response status:", response.status_code)
-        print("Response json:", response.json())
-        
-        assert response.status_code == 200
-        data = response.json()
-        assert "Successfully processed" in data["message"]
-        assert len(data["details"]) == 1
-        metadata = data["details"][0]["metadata"]
-        print("Generated Metadata:", metadata)
-        
-        assert "title" in metadata
-        assert "subject" in metadata
+        # Entering the client runs the startup handlers (background ingest worker)
+        with TestClient(app) as client:
+            # Upload the file without subject
+            with open(filename, "rb") as f:
+                response = client.post(
+                    "/upload",
+                    files={"files": (filename, f, "text/plain")}
+                )
+            
+            print("Response status:", response.status_code)
+            print("Response json:", response.json())
+            
+            assert response.status_code == 200
+            data = response.json()
+            assert "Successfully processed" in data["message"]
+            assert len(data["details"]) == 1
+            metadata = data["details"][0]["metadata"]
+            print("Generated Metadata:", metadata)
+            
+            assert "title" in metadata
+            assert "subject" in metadata
+            
+            # Embedding runs in the background; wait for the job to finish
+            for _ in range(100):
+                status = client.get(f"/upload/{data['job_id']}").json()
+                if status["status"] != "pending":
+                    break
+                time.sleep(0.1)
+            print("Job status:", status)
+            assert status["status"] == "done"
         
         # Verify it's in RAG
         docs = rag.list_documents()
@@ -0,0 +1,37 @@
+import os
+import atexit
+import shutil
+import tempfile
+from rag import FaissRAG
+
+def test_subject_search_after_unsaved_index():
+    # Chunks reach SQLite immediately but the FAISS index is only written by the debounced save;
+    # reopening before that save leaves ids in SQLite that the index does not contain
+    tmp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(tmp_dir, "rag.db")
+    index_path = os.path.join(tmp_dir, "faiss.index")
+
+    try:
+        rag = FaissRAG(db_path=db_path, index_path=index_path, save_interval=3600)
+        rag.add_text("Photosynthesis converts light energy into chemical energy in plants.",
+                     metadata={"title": "Plants", "subject": "Biology"})
+        # simulate a crash: neither the debounced save nor the exit flush runs
+        atexit.unregister(rag.flush)
+        rag.close()
+        assert not os.path.exists(index_path)
+        rag = FaissRAG(db_path=db_path, index_path=index_path, save_interval=3600)
+
+        # the semantic leg has nothing for the subject, the keyword leg still finds the chunk
+        assert rag.search_similarity("photosynthesis", k=5, subject="Biology") == []
+        results = rag.hybrid_search("photosynthesis", k=5, subject="biology")
+        print("Hybrid results:", results)
+        assert len(results) == 1
+        assert results[0]["metadata"]["subject"] == "Biology"
+        # write pending state now, so the exit flush has nothing left to write into tmp_dir
+        rag.flush()
+        rag.close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    test_subject_search_after_unsaved_index()